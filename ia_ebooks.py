@@ -1,17 +1,119 @@
+import sys
 from sys import stderr
-from io import BytesIO
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from threading import Lock
+from time import monotonic, sleep
 import json
 import re
-from time import sleep
+from urllib.parse import urlencode
 # library dependencies
 import requests
-from pymarc import MARCReader, Record
-from pymarc.exceptions import RecordLengthInvalid
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from pymarc import Record
+from pymarc.exceptions import PymarcException
 
 CLIO_DERIVED_ID = re.compile('^ldpd[_]+([0-9A-Za-z]+)[_]+\\d+$')
-CLIO_LINK = re.compile('"http:\\/\\/clio.columbia.edu\\/catalog\\/([0-9A-Za-z]+)"')
+CLIO_LINK = re.compile('"http:\\/\\/clio.columbia.edu\\/catalog\\/([0-9A-Za-z]+)"', re.ASCII)
+CLIO_MARC_URL = "https://clio.columbia.edu/catalog/%s.marc"
+IA_SEARCH_URL = "https://archive.org/advancedsearch.php"
+# concurrent CLIO requests; kept small to respect CLIO rate limits
+CLIO_WORKERS = 8
+# CLIO requests per second across all workers, and attempts per record when rate limited anyway
+CLIO_RATE = 5
+CLIO_RATE_LIMIT_ATTEMPTS = 5
+# larger pages mean fewer round trips to IA at the cost of holding more documents in memory
+IA_PAGE_SIZE = 500
+IA_MAX_PAGE_SIZE = 10000
+# locate the parts of an IA search response needed to decode its docs one at a time
+IA_NUM_FOUND = re.compile('"numFound"\\s*:\\s*(\\d+)')
+IA_DOCS_START = re.compile('"docs"\\s*:\\s*\\[\\s*')
+JSON_SEPARATOR = re.compile('\\s*(,?)\\s*')
+JSON_DECODER = json.JSONDecoder()
+# one encoder for all output; UTF-8 text is written as-is rather than escaped
+JSON_ENCODER = json.JSONEncoder(indent=2, ensure_ascii=False)
 
-def query_internet_archive(queries, page_size=50, page=1):
+def http_session(retries=3, backoff_factor=0.5, pool_size=16, status_forcelist=(429, 500, 502, 503, 504)):
+	"""
+	build a keep-alive session that pools connections and backs off on rate limits or server errors.
+	threads wait for a pooled connection rather than open more than pool_size to a host.
+
+	:param retries: the number of times to retry a request
+	:param backoff_factor: the urllib3 exponential backoff factor, in seconds
+	:param pool_size: the most connections kept open to a host
+	:param status_forcelist: the response statuses to retry
+	:returns: a requests.Session
+	"""
+	retry = Retry(total=retries, backoff_factor=backoff_factor, status_forcelist=status_forcelist,
+		respect_retry_after_header=True, raise_on_status=False)
+	adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, pool_block=True, max_retries=retry)
+	session = requests.Session()
+	session.mount('https://', adapter)
+	session.mount('http://', adapter)
+	return session
+
+def clio_session(workers=CLIO_WORKERS):
+	"""
+	build a session for CLIO requests from a number of concurrent workers
+
+	:param workers: the number of threads that will share the session
+	:returns: a requests.Session
+	"""
+	# we love you CLIO: 429s are left to _CLIO_LIMITER, with one kept-alive connection per worker
+	return http_session(retries=5, backoff_factor=1.0, pool_size=workers, status_forcelist=(500, 502, 503, 504))
+
+class RateLimiter:
+	"""
+	A token bucket shared between threads, allowing rate requests per second in bursts of up to burst
+
+	throttle() empties the bucket and holds all requests for a server's Retry-After window,
+	then refills at half the rate for as long again.
+	Tokens are only taken by the thread that sends a request, so waiting threads hold none.
+	"""
+	def __init__(self, rate, burst=1):
+		self.rate = rate
+		self.burst = burst
+		self._lock = Lock()
+		self._tokens = float(burst)
+		self._updated = monotonic()
+		self._paused_until = 0.0
+		self._slowed_until = 0.0
+	def __refill__(self, now):
+		elapsed = max(0.0, now - self._updated)
+		slowed = max(0.0, min(now, self._slowed_until) - self._updated)
+		self._tokens = min(self.burst, self._tokens + ((elapsed - slowed) * self.rate) + (slowed * self.rate / 2))
+		self._updated = max(self._updated, now)
+	def acquire(self):
+		while True:
+			with self._lock:
+				now = monotonic()
+				if now < self._paused_until:
+					wait = self._paused_until - now
+				else:
+					self.__refill__(now)
+					if self._tokens >= 1:
+						self._tokens -= 1
+						return
+					rate = (self.rate / 2) if now < self._slowed_until else self.rate
+					wait = (1 - self._tokens) / rate
+			sleep(wait)
+	def throttle(self, seconds):
+		with self._lock:
+			self._paused_until = max(self._paused_until, monotonic() + seconds)
+			self._slowed_until = max(self._slowed_until, self._paused_until + seconds)
+			# nothing accrues during the pause
+			self._tokens = 0.0
+			self._updated = self._paused_until
+
+_IA_SESSION = http_session()
+_CLIO_SESSION = clio_session()
+_CLIO_LIMITER = RateLimiter(CLIO_RATE, CLIO_RATE)
+# CLIO bib ids that did not yield a MARC record
+_CLIO_MISSING = set()
+
+def query_internet_archive(queries, page_size=50, page=1, fields=None):
 	q = ' AND '.join(["%s:(%s)" % query for query in queries])
 	params = {
 		'q': q,
@@ -21,101 +123,178 @@ def query_internet_archive(queries, page_size=50, page=1):
 		'output': 'json',
 		'sort[]': '__sort desc'
 	}
-	response = requests.get("https://archive.org/advancedsearch.php", params=params)
-	return json.loads(response.text)
+	if fields is not None:
+		params['fl[]'] = list(fields)
+	response = _IA_SESSION.get(IA_SEARCH_URL, params=params)
+	return json.loads(response.content)
+
+def parse_search_page(body):
+	"""
+	read the result count of an IA search response, deferring the decoding of each doc until it is consumed
+
+	:param body: the IA response text
+	:returns: a tuple of the numFound value and an iterator of IA documents
+	"""
+	num_found = IA_NUM_FOUND.search(body)
+	docs_start = IA_DOCS_START.search(body)
+	if num_found is None or docs_start is None:
+		response = json.loads(body)
+		return (int(response['response']['numFound']), iter(response['response']['docs']))
+	return (int(num_found.group(1)), iter_docs(body, docs_start.end()))
+
+def iter_docs(body, index):
+	"""
+	decode the JSON objects of an array one at a time
+
+	:param body: the JSON text
+	:param index: the position of the first array element
+	:returns: an iterator of the decoded elements
+	"""
+	while body[index] != ']':
+		doc, index = JSON_DECODER.raw_decode(body, index)
+		yield doc
+		separator = JSON_SEPARATOR.match(body, index)
+		index = separator.end()
+		if not separator.group(1):
+			break
 
 class IA:
 	"""
 	An iterable class to prevent storing many large IA requests in memory
+
+	The next page is requested in a background thread while the current page is consumed.
+	Up to two pages of page_size documents are held at once; page_size is capped at max_page_size.
+	Documents are decoded from the page text as they are consumed.
+	Consumers that may stop early should close() it, or use it as a context manager,
+	so the prefetch thread does not outlive them.
 	"""
-	def __init__(self, queries, page_size=50, page=1):
+	def __init__(self, queries, page_size=IA_PAGE_SIZE, page=1, fields=None, max_page_size=IA_MAX_PAGE_SIZE):
 		self.params = {
 			'q': ' AND '.join(["%s:(%s)" % query for query in queries]),
 			'callback': '',
-			'rows': page_size,
+			'rows': min(page_size, max_page_size),
 			'output': 'json',
 			'sort[]': '__sort desc',
 			'page': (page - 1) # will iterate when first page is fetched
 		}
-		self.docs = []
+		if fields is not None:
+			self.params['fl[]'] = list(fields) # only return these document fields
+		# only the page changes between requests, so encode everything else once
+		base_params = {key: value for (key, value) in self.params.items() if key != 'page'}
+		self._base_url = IA_SEARCH_URL + '?' + urlencode(base_params, doseq=True)
+		self.docs = iter(())
 		self.more = True
+		self._executor = None
+		self._next_future = None
+	def __get_page__(self, page):
+		response_body = _IA_SESSION.get("%s&page=%d" % (self._base_url, page)).content
+		return parse_search_page(response_body.decode('utf-8'))
 	def __fetch_next_page__(self):
 		self.params.update({ 'page': (self.params['page'] + 1) })
-		response_body = requests.get("https://archive.org/advancedsearch.php", params=self.params).text
-		response = json.loads(response_body)
-		self.docs = response['response']['docs']
-		numFound = int(response['response']['numFound'])
+		if self._next_future is None:
+			numFound, self.docs = self.__get_page__(self.params['page'])
+		else:
+			numFound, self.docs = self._next_future.result()
+			self._next_future = None
 		self.more = numFound > (self.params['rows'] * self.params['page'])
+		if self.more:
+			if self._executor is None:
+				self._executor = ThreadPoolExecutor(max_workers=1)
+			self._next_future = self._executor.submit(self.__get_page__, self.params['page'] + 1)
+	def __shutdown__(self):
+		if self._next_future is not None:
+			self._next_future.cancel()
+			self._next_future = None
+		if self._executor is not None:
+			self._executor.shutdown(wait=False)
+			self._executor = None
+	def close(self):
+		self.__shutdown__()
+		self.docs = iter(())
+		self.more = False
+	def __enter__(self):
+		return self
+	def __exit__(self, *exc_info):
+		self.close()
 	def __iter__(self):
-		self.docs = []
+		self.__shutdown__()
+		self.docs = iter(())
 		self.more = True
 		return self
 	def __next__(self):
-		if len(self.docs) == 0 and self.more:
+		doc = next(self.docs, None)
+		if doc is None and self.more:
 			self.__fetch_next_page__()
-		if len(self.docs) == 0:
+			doc = next(self.docs, None)
+		if doc is None:
+			self.__shutdown__()
 			raise StopIteration
-		return self.docs.pop(0)
+		return doc
 
 
 
-def fetch_iter(collection='ColumbiaUniversityLibraries', mediatype='collection', page_size=50):
+def fetch_iter(collection='ColumbiaUniversityLibraries', mediatype='collection', page_size=IA_PAGE_SIZE, fields=None):
 	"""
 	get an iterator for the matching documents
 
 	:param collection: the IA collection id
 	:param mediatype: collection or texts
 	:param page_size
-	:returns: an iterator of IA results
+	:param fields: the document fields to return, or None for all fields
+	:returns: an IA iterator of results, to be closed if not consumed to the end
 	"""
 	queries = [
 		('collection', collection),
 		('mediatype', mediatype)
 	]
-	return iter(IA(queries, page_size))
+	return iter(IA(queries, page_size, fields=fields))
 
-def fetch_list(collection='ColumbiaUniversityLibraries', mediatype='collection', page_size=50):
+def fetch_list(collection='ColumbiaUniversityLibraries', mediatype='collection', page_size=IA_PAGE_SIZE, fields=None):
 	"""
 	get all the matching documents, intermediate pages of page_size fetched.
 
 	:param collection: the IA collection id
 	:param mediatype: collection or texts
 	:param page_size
+	:param fields: the document fields to return, or None for all fields
 	:returns: a list of IA results
 	"""
 	queries = [
 		('collection', collection),
 		('mediatype', mediatype)
 	]
+	page_size = min(page_size, IA_MAX_PAGE_SIZE)
 	page = 0
 	numFound = 1
 	docs = []
 	while numFound > (page_size * page):
 		page += 1
-		response = query_internet_archive(queries, page_size, page)
+		response = query_internet_archive(queries, page_size, page, fields)
 		numFound = int(response['response']['numFound'])
 		docs.extend(response['response']['docs'])
 	return docs
 
-def fetch_ebooks(collection='ColumbiaUniversityLibraries', page_size=50):
+def fetch_ebooks(collection='ColumbiaUniversityLibraries', page_size=IA_PAGE_SIZE, fields=None):
 	"""
 	get all the ebooks in a collection, intermediate pages of page_size fetched.
 
 	:param collection: the containing IA collection id
 	:param page_size
-	:returns: an iterator of IA ebook documents
+	:param fields: the document fields to return, or None for all fields
+	:returns: an IA iterator of ebook documents
 	"""
-	return fetch_iter(collection, 'texts', page_size)
+	return fetch_iter(collection, 'texts', page_size, fields)
 
-def fetch_collections(collection='ColumbiaUniversityLibraries', page_size=50):
+def fetch_collections(collection='ColumbiaUniversityLibraries', page_size=IA_PAGE_SIZE, fields=None):
 	"""
 	get all the collections in a collection, intermediate pages of page_size fetched.
 
 	:param collection: the containing IA collection id
 	:param page_size
-	:returns: an iterator of IA collection documents
+	:param fields: the document fields to return, or None for all fields
+	:returns: an IA iterator of collection documents
 	"""
-	return fetch_iter(collection, 'collection', page_size)
+	return fetch_iter(collection, 'collection', page_size, fields)
 
 def fetch_document(identifier):
 	"""
@@ -134,6 +313,26 @@ def fetch_document(identifier):
 	else:
 		return None
 
+def fetch_documents(identifiers, batch_size=100):
+	"""
+	get many documents from IA by id, with one query per batch of ids
+
+	:param identifiers: the IA document ids
+	:param batch_size: the most ids to put in a single query
+	:returns: a dictionary of IA documents by identifier
+	"""
+	identifiers = list(identifiers)
+	docs = {}
+	for start in range(0, len(identifiers), batch_size):
+		batch = identifiers[start:(start + batch_size)]
+		queries = [
+			('identifier', ' OR '.join(batch))
+		]
+		response = query_internet_archive(queries, len(batch), 1)
+		for doc in response['response']['docs']:
+			docs[doc['identifier']] = doc
+	return docs
+
 def clio_id(doc):
 	"""
 	inspect an IA document for its apparent CLIO bib id
@@ -141,71 +340,185 @@ def clio_id(doc):
 	:param doc: the IA document
 	:returns: a String CLIO bib id
 	"""
-	bib_id = None
 	id_match = CLIO_DERIVED_ID.match(doc['identifier'])
 	if id_match:
-		bib_id = id_match.group(1)
-	if bib_id is None:
-		link_match = CLIO_LINK.search(doc.get('stripped_tags',''))
-		if link_match:
-			bib_id = link_match.group(1)
-	return bib_id
+		return id_match.group(1)
+	tags = doc.get('stripped_tags')
+	if not tags:
+		return None
+	link_match = CLIO_LINK.search(tags)
+	if link_match:
+		return link_match.group(1)
+	return None
+
+@lru_cache(maxsize=4096)
+def _fetch_clio_bytes(identifier):
+	"""
+	get the MARC response body for a CLIO bib id, memoized by identifier.
+	only definitive answers are memoized: failures after retries raise instead.
+
+	:param identifier: the CLIO bib id
+	:returns: the response body bytes, or empty bytes if CLIO has no such record
+	:raises requests.HTTPError: if CLIO is still rate limiting or failing
+	"""
+	for _ in range(CLIO_RATE_LIMIT_ATTEMPTS):
+		_CLIO_LIMITER.acquire()
+		response = _CLIO_SESSION.get(CLIO_MARC_URL % identifier)
+		if response.status_code != 429:
+			break
+		try:
+			retry_after = float(response.headers.get('Retry-After', 1))
+		except ValueError: # an HTTP date rather than seconds
+			retry_after = 1.0
+		print(("CLIO rate limiting, waiting %s: %s" % (retry_after, response.url)), file=stderr)
+		_CLIO_LIMITER.throttle(retry_after)
+	if response.status_code == 404:
+		return b''
+	response.raise_for_status()
+	return response.content
 
-def fetch_clio(identifier, retry_after=-1):
+def is_marc(marc):
+	"""
+	cheaply check that bytes hold a whole MARC record, per the record length in its leader
+
+	:param marc: the bytes to check
+	:returns: True if the bytes start with a complete, terminated MARC record
+	"""
+	if len(marc) < 24 or not marc[:5].isdigit():
+		return False
+	length = int(marc[:5])
+	return (24 <= length <= len(marc)) and (marc[length - 1] == 0x1D)
+
+def fetch_clio(identifier, parse=True):
 	"""
 	get a single document from CLIO by id
 
 	:param identifier: the CLIO bib id
-	:param retry_after: seconds to sleep before fetching
-	:returns: a pymarc.Record
+	:param parse: False to skip pymarc and return the MARC bytes as served
+	:returns: a pymarc.Record, or bytes if not parsing; if CLIO has no record or cannot be reached,
+		an empty pymarc.Record, or None if not parsing
 	"""
-	if retry_after != -1: sleep(retry_after) # we love you CLIO
-	response = requests.get("https://clio.columbia.edu/catalog/%s.marc" % identifier)
-	marc_reader = MARCReader(BytesIO(response.content))
+	missing = Record() if parse else None
+	if identifier in _CLIO_MISSING:
+		return missing
 	try:
-		return next(marc_reader)
-	except (ValueError, RecordLengthInvalid):
-		if (retry_after == -1) and (response.status_code == 429):
-			retry_after = int(response.headers['Retry-After']) + 1
-			print(("CLIO rate limiting, waiting %s: %s" % (retry_after, response.url)), file=stderr)
-			print(json.dumps(dict(response.headers)), file=stderr)
-			return fetch_clio(identifier, retry_after)
-		else:
-			print(("Collegially retrying only once: %s" % response.url), file=stderr)
-			return Record()
+		marc = _fetch_clio_bytes(identifier)
+	except requests.RequestException as e:
+		# not remembered as missing; a later call will ask CLIO again
+		print(("CLIO unavailable: %s (%s)" % ((CLIO_MARC_URL % identifier), e)), file=stderr)
+		return missing
+	if not parse:
+		if is_marc(marc):
+			return marc
+	elif marc:
+		try:
+			# decode the cached body in place rather than copying it through a MARCReader
+			return Record(data=marc)
+		except (ValueError, PymarcException):
+			pass
+	print(("No MARC record from CLIO: %s" % (CLIO_MARC_URL % identifier)), file=stderr)
+	_CLIO_MISSING.add(identifier)
+	return missing
 
 def ia_links(doc):
 	"""
-	inspect an IA document for its apparent CLIO bib id
+	build the thumbnail, poster, pdf and viewer links for an IA document
 
 	:param doc: the IA document
 	:returns: a dictionary of links
 	"""
 	ia_id = doc['identifier']
 	return {
-		'thumbnail': ("https://archive.org/services/img/%s" % ia_id),
-		'poster': ("https://archive.org/download/%s/page/cover_medium.jpg" % ia_id),
-		'pdf': ("https://archive.org/download/%s/%s.pdf" % (ia_id, ia_id)),
-		'iframe': ("https://archive.org/stream/%s?ui=full&showNavbar=false" % ia_id)
+		'thumbnail': f"https://archive.org/services/img/{ia_id}",
+		'poster': f"https://archive.org/download/{ia_id}/page/cover_medium.jpg",
+		'pdf': f"https://archive.org/download/{ia_id}/{ia_id}.pdf",
+		'iframe': f"https://archive.org/stream/{ia_id}?ui=full&showNavbar=false"
 	}
 
+def _enrich(doc):
+	"""
+	merge an IA document with its CLIO data and links
+
+	:param doc: the IA document
+	:returns: the merged dictionary
+	"""
+	enriched = {'clio': fetch_clio(clio_id(doc)).as_dict()}
+	enriched.update(ia_links(doc))
+	enriched.update(doc)
+	return enriched
+
+def _with_links(doc, clio=False):
+	"""
+	add links, and optionally CLIO data, to an IA document in place
+
+	:param doc: the IA document
+	:param clio: whether to add CLIO data
+	:returns: the document
+	"""
+	if clio:
+		doc['clio'] = fetch_clio(clio_id(doc)).as_dict()
+	doc['links'] = ia_links(doc)
+	return doc
+
+def parallel_map(func, iterable, max_workers=CLIO_WORKERS):
+	"""
+	lazily map a function over an iterable in a bounded thread pool, preserving order.
+	unlike Executor.map, at most 2 * max_workers items are read ahead of the consumer.
+
+	:param func: the function to apply
+	:param iterable: the input items
+	:param max_workers: the number of concurrent calls
+	:returns: an iterator of results
+	"""
+	with ThreadPoolExecutor(max_workers=max_workers) as executor:
+		pending = deque()
+		for item in iterable:
+			pending.append(executor.submit(func, item))
+			if len(pending) >= (max_workers * 2):
+				yield pending.popleft().result()
+		while pending:
+			yield pending.popleft().result()
+
+def encode_document(doc):
+	"""
+	serialize a document for output, independent of the stdout text encoding
+
+	:param doc: the document
+	:returns: indented JSON as UTF-8 bytes
+	"""
+	return JSON_ENCODER.encode(doc).encode('utf-8')
+
+def dump_document(doc):
+	"""
+	prints a single document, writing encoded bytes through the stdout buffer
+
+	:param doc: the document
+	"""
+	sys.stdout.flush()
+	sys.stdout.buffer.write(encode_document(doc) + b'\n')
+	sys.stdout.buffer.flush()
+
 def dump_iterable(docs):
 	"""
-	prints an iterable
+	prints an iterable as a JSON array, writing encoded bytes through the stdout buffer
 
 	:param docs: the iterator of documents
 	"""
 	# print the containing brackets in anticipation of large iterable
-	print('[')
+	sys.stdout.flush()
+	out = sys.stdout.buffer
+	out.write(b'[\n')
 	doc = next(docs, None)
 	if doc is not None:
-		print(json.dumps(doc, indent=2))
+		out.write(encode_document(doc))
 		doc = next(docs, None)
 		while doc is not None:
-			print(',')
-			print(json.dumps(doc, indent=2))
+			out.write(b'\n,\n')
+			out.write(encode_document(doc))
 			doc = next(docs, None)
-	print(']')
+		out.write(b'\n')
+	out.write(b']\n')
+	out.flush()
 
 def help(command=None):
 	if command is not None: print("python ia_ebooks.py %s" % command)
@@ -215,54 +528,84 @@ def help(command=None):
 	print('cmd "ebook": get one ebook by identifier.')
 
 if __name__ == "__main__":
-	import sys
 	import argparse
 
 	parser = argparse.ArgumentParser(description='Fetch Internet Archive Ebooks.')
 	parser.add_argument('command', nargs='?', default='help', help='the fetch command: list-collections, list-ebooks, ebook, clio')
-	parser.add_argument('identifier', nargs='?', default=None, help='the document identifier to fetch (IA or CLIO per command)')
+	parser.add_argument('identifier', nargs='*', help='the document identifier(s) to fetch (IA or CLIO per command)')
 	parser.add_argument('-C', '--collection', help='collection to query', default='ColumbiaUniversityLibraries')
-	parser.add_argument('-F', '--format', help='how to display data: json (default) or tsv (of identifiers)', default='json')
+	parser.add_argument('-F', '--format', help='how to display data: json (default), tsv (of identifiers) or marc (clio command only)', default='json')
 	parser.add_argument('--clio', help='add clio data', action="store_true", default=False)
+	parser.add_argument('-W', '--workers', help=('concurrent CLIO requests when adding clio data (default %s)' % CLIO_WORKERS), type=int, default=CLIO_WORKERS)
 	args = parser.parse_args()
+	if args.workers < 1:
+		parser.error('at least one worker is required.')
+	if args.workers != CLIO_WORKERS:
+		_CLIO_SESSION = clio_session(args.workers)
 	if args.command == "list-collections":
+		fields = ['identifier', 'description']
 		if args.format == 'json':
 			# use a generator to lazily map to identifier and description keys
-			dump_iterable(({'identifier':doc['identifier'], 'description': doc['description'] } for doc in fetch_collections(args.collection)))
+			with fetch_collections(args.collection, fields=fields) as docs:
+				dump_iterable(({'identifier':doc['identifier'], 'description': doc['description'] } for doc in docs))
 		else:
 			print("identifier\tdescription")
-			for doc in fetch_collections(args.collection):
-				print("%s\t%s" % (doc['identifier'], doc['description']))
+			with fetch_collections(args.collection, fields=fields) as docs:
+				for doc in docs:
+					print("%s\t%s" % (doc['identifier'], doc['description']))
 	elif args.command == "list-ebooks":
-		if args.identifier is not None:
+		if args.identifier:
 			parser.error('use the collection flag "-C" to scope ebook list to a collection')
 		if args.format == 'json':
-			docs = fetch_ebooks(args.collection, 100)
-			if args.clio:
-				# use a generator to lazily add clio data
-				dump_iterable(({'clio': fetch_clio(clio_id(doc)).as_dict(), **ia_links(doc), **doc} for doc in docs))
-			else:
-				dump_iterable({**doc, 'links': ia_links(doc)} for doc in docs)
+			with fetch_ebooks(args.collection) as docs:
+				if args.clio:
+					# overlap CLIO requests in a bounded pool
+					dump_iterable(parallel_map(_enrich, docs, args.workers))
+				else:
+					dump_iterable(_with_links(doc) for doc in docs)
 		else:
 			print("identifier\tclio_id")
-			for doc in fetch_ebooks("muslim-world-manuscripts", 100):
-				print("%s\t%s" % (doc['identifier'], clio_id(doc)))
+			with fetch_ebooks("muslim-world-manuscripts", fields=['identifier', 'stripped_tags']) as docs:
+				for doc in docs:
+					print("%s\t%s" % (doc['identifier'], clio_id(doc)))
 	elif args.command == "ebook":
-		if args.identifier is None:
+		if not args.identifier:
 			parser.error('an identifier is required to fetch a single document.')
-		doc = fetch_document(args.identifier)
+		# fetch all the requested ebooks in as few IA queries as possible
+		found = fetch_documents(args.identifier)
+		docs = []
+		for identifier in args.identifier:
+			if identifier in found:
+				docs.append(found[identifier])
+			else:
+				print(("No IA document: %s" % identifier), file=stderr)
+		if not docs:
+			sys.exit(1)
 		if args.format == 'json':
 			if args.clio:
-				json.dumps({**doc, 'clio': fetch_clio(clio_id(doc)).as_dict(), 'links': ia_links(doc)}, indent=2)
+				docs = parallel_map(lambda doc: _with_links(doc, clio=True), docs, args.workers)
 			else:
-				json.dumps({**doc, 'links': ia_links(doc)}, indent=2)
+				docs = (_with_links(doc) for doc in docs)
+			if len(args.identifier) == 1:
+				for doc in docs:
+					dump_document(doc)
+			else:
+				dump_iterable(docs)
 		else:
 			print("identifier\tclio_id")
-			print("%s\t%s" % (doc['identifier'], clio_id(doc)))
+			for doc in docs:
+				print("%s\t%s" % (doc['identifier'], clio_id(doc)))
 	elif args.command == "clio":
-		if args.identifier is None:
-			parser.error('an identifier is required to fetch a single document.')
-		clio_record = fetch_clio(args.identifier)
-		print(clio_record.as_json(indent=2))
+		if len(args.identifier) != 1:
+			parser.error('one identifier is required to fetch a single document.')
+		if args.format == 'marc':
+			# pass the MARC through without building a pymarc.Record
+			marc = fetch_clio(args.identifier[0], parse=False)
+			if marc is None:
+				sys.exit(1)
+			sys.stdout.buffer.write(marc)
+		else:
+			clio_record = fetch_clio(args.identifier[0])
+			print(clio_record.as_json(indent=2))
 	else:
 		parser.print_help()